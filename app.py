@@ -1,11 +1,14 @@
 import streamlit as st
 import google.generativeai as genai
 import re
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import urllib.parse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # API 키 검증
 if not st.secrets["GEMINI_API_KEY"]:
@@ -21,7 +24,39 @@ if not st.secrets["GEMINI_API_KEY"]:
 
 # Gemini API 설정
 genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
-model = genai.GenerativeModel('gemini-1.5-flash')
+
+@st.cache_resource
+def get_model():
+    """재실행마다 새로 만들지 않도록 Gemini 모델을 한 번만 생성"""
+    return genai.GenerativeModel('gemini-1.5-flash')
+
+model = get_model()
+
+@st.cache_resource
+def get_http_session():
+    """연결을 재사용하도록 커넥션 풀이 있는 HTTP 세션을 한 번만 생성"""
+    session = requests.Session()
+    session.headers.update({
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+    })
+    adapter = HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=16,
+        max_retries=Retry(total=2, backoff_factor=0.3)
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+@st.cache_resource
+def get_naver_semaphore():
+    """모든 세션이 함께 쓰는 네이버 동시 요청 수 제한을 한 번만 생성"""
+    return threading.Semaphore(4)
+
+@st.cache_resource
+def get_executor():
+    """네이버 조회에 쓰는 스레드 풀을 한 번만 생성"""
+    return ThreadPoolExecutor(max_workers=8)
 
 # 활동별 기본 소요 시간 (분)
 DEFAULT_DURATIONS = {
@@ -39,6 +74,49 @@ DEFAULT_DURATIONS = {
     "쇼핑": 90,
     "default": 60
 }
+_DURATION_ITEMS = [(k.lower(), v) for k, v in DEFAULT_DURATIONS.items() if k != "default"]
+_DEFAULT_DURATION = DEFAULT_DURATIONS["default"]
+
+# 다운로드 파일에 표시할 역할 이름
+ROLES = {
+    "user": "👤 사용자",
+    "assistant": "🤖 챗봇"
+}
+
+# 날짜 패턴 (정규식 실행 전 확인할 문자열, 패턴)
+_DATE_PATTERNS = [(anchor, re.compile(p)) for anchor, p in [
+    ("월", r'(\d{4}년\s*)?(\d{1,2})월\s*(\d{1,2})일'),  # 2024년 3월 15일, 3월 15일
+    ("오늘", r'오늘'),
+    ("내일", r'내일'),
+    ("모레", r'모레'),
+    ("다음주", r'다음주\s*(월|화|수|목|금|토|일)요일'),
+    ("이번주", r'이번주\s*(월|화|수|목|금|토|일)요일'),
+]]
+
+# 시간 패턴 (정규식 실행 전 확인할 문자열, 패턴) - 오전/오후는 시간 바로 앞의 단어로 판단
+_TIME_PATTERNS = [(anchor, re.compile(p)) for anchor, p in [
+    ("시", r'(\d{1,2})시\s*(\d{1,2})?분?'),  # 17시 30분, 17시30분, 오후 5시
+    (":", r'(\d{1,2}):(\d{2})'),  # 17:30, 오후 5:30
+]]
+
+# 피드백 요청 판별용 키워드
+_FEEDBACK_RE = re.compile('바꿔|교체|다른|비싸|너무|별로')
+# 피드백에서 특정 코스를 가리키는 표현 (코스 2, 2번)
+_COURSE_REF_RE = re.compile(r'코스\s*\d+|\d+\s*번')
+
+# 추천 결과 파싱용 정규식
+_COURSE_HEADER_RE = re.compile(r'### \*\*\[코스 \d+\]')
+_ACTIVITY_RE = re.compile(r'🎯\s*내용:\s*([^\n]+)')
+_LINK_RE = re.compile(r'🔗[ \t]*네이버 링크:[ \t]*([^\n]*)')
+_URL_RE = re.compile(r'🔗 네이버 링크: (https://place\.naver\.com/[^\n]+)')
+_NAME_RE = re.compile(r'\[코스 \d+\]\s*([^\n]+)')
+_PAREN_RE = re.compile(r'\([^)]*\)\**')
+_RATING_LINE_RE = re.compile(r'⭐ 별점: [^\n]+')
+_FIELD_LINE_RE = re.compile(r'^(?:🎯|✨|💰|⭐|🔗)[^\n]*', re.MULTILINE)
+
+# 네이버 플레이스 HTML에서 별점과 리뷰 수를 찾는 정규식
+_RATING_RE = re.compile(rb'<span class="[^"]*rating[^"]*"[^>]*>([^<]+)</span>')
+_REVIEW_COUNT_RE = re.compile(rb'<span class="[^"]*review_count[^"]*"[^>]*>([^<]+)</span>')
 
 # 시스템 프롬프트 수정
 context = """
@@ -75,33 +153,18 @@ context = """
 
 def extract_date_time(prompt):
     """사용자 입력에서 날짜와 시간을 추출"""
-    # 날짜 패턴
-    date_patterns = [
-        r'(\d{4}년\s*)?(\d{1,2})월\s*(\d{1,2})일',  # 2024년 3월 15일, 3월 15일
-        r'오늘',
-        r'내일',
-        r'모레',
-        r'다음주\s*(월|화|수|목|금|토|일)요일',
-        r'이번주\s*(월|화|수|목|금|토|일)요일',
-    ]
-    
-    # 시간 패턴
-    time_patterns = [
-        r'(\d{1,2})시\s*(\d{1,2})?분?',  # 17시 30분, 17시
-        r'(\d{1,2}):(\d{2})',  # 17:30
-        r'(\d{1,2})[시:](\d{2})',  # 17시30분, 17:30
-        r'오전\s*(\d{1,2})시',  # 오전 11시
-        r'오후\s*(\d{1,2})시',  # 오후 5시
-    ]
-    
+    return _parse_date_time(prompt, date.today())
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _parse_date_time(prompt, today):
+    """기준 날짜에 대해 날짜와 시간을 파싱 (같은 입력은 캐시된 결과 사용)"""
     # 기본값 설정
-    today = datetime.now()
     date_str = today.strftime("%Y-%m-%d")
     time_str = "17:00"
     
     # 날짜 추출
-    for pattern in date_patterns:
-        if match := re.search(pattern, prompt):
+    for anchor, pattern in _DATE_PATTERNS:
+        if anchor in prompt and (match := pattern.search(prompt)):
             if "오늘" in match.group():
                 date_str = today.strftime("%Y-%m-%d")
             elif "내일" in match.group():
@@ -127,26 +190,25 @@ def extract_date_time(prompt):
                 month = int(match.group(2))
                 day = int(match.group(3))
                 date_str = f"{year}-{month:02d}-{day:02d}"
+            break
     
-    # 시간 추출
-    for pattern in time_patterns:
-        if match := re.search(pattern, prompt):
-            if "오전" in pattern:
-                hour = int(match.group(1))
-            elif "오후" in pattern:
-                hour = int(match.group(1)) + 12
-            else:
-                hour = int(match.group(1))
-                if hour < 12 and "오후" in prompt:
-                    hour += 12
-            
-            minute = int(match.group(2)) if len(match.groups()) > 1 and match.group(2) else 0
-            time_str = f"{hour:02d}:{minute:02d}"
+    # 시간 추출 (가장 먼저 나온 시간을 시작 시간으로 사용)
+    matches = [m for anchor, pattern in _TIME_PATTERNS if anchor in prompt and (m := pattern.search(prompt))]
+    if matches:
+        match = min(matches, key=lambda m: m.start())
+        hour = int(match.group(1))
+        minute = int(match.group(2)) if match.group(2) else 0
+        
+        # 문장 전체가 아니라 시간 바로 앞의 "오후"만 보고 12시간 더하기
+        if hour < 12 and prompt[:match.start()].rstrip().endswith("오후"):
+            hour += 12
+        
+        time_str = f"{hour:02d}:{minute:02d}"
     
     return date_str, time_str
 
-def create_timeline(recommendations, start_time):
-    """추천 장소들로 시간표 생성"""
+def create_timeline(courses, start_time):
+    """update_place_info가 파싱한 (장소, 활동, 링크) 목록으로 시간표 생성"""
     try:
         current_time = datetime.strptime(start_time, "%H:%M")
         timeline = []
@@ -155,29 +217,13 @@ def create_timeline(recommendations, start_time):
         timeline.append("| 시간 | 활동 | 장소 | 링크 |")
         timeline.append("|------|------|------|------|")
         
-        # 코스 정보 추출을 위한 정규식 패턴 수정
-        pattern = r'\[코스 \d+\]\s*([^\n]+).*?🎯\s*내용:\s*([^\n]+).*?🔗\s*네이버 링크:\s*([^\n]+)'
-        places = re.findall(pattern, recommendations, re.DOTALL)
-        
-        if not places:
-            # 백업 패턴: URL이 없는 경우를 위한 처리
-            pattern = r'\[코스 \d+\]\s*([^\n]+).*?🎯\s*내용:\s*([^\n]+)'
-            places = re.findall(pattern, recommendations, re.DOTALL)
-            places = [(p[0], p[1], "#") for p in places]
-        
-        for name, activity, link in places:
-            name = name.strip()
-            activity = activity.strip()
-            link = link.strip()
+        for name, activity, link in courses:
+            if not activity:
+                continue
             
             # 활동 시간 계산
-            duration = 0
-            for key, value in DEFAULT_DURATIONS.items():
-                if key in activity.lower():
-                    duration = value
-                    break
-            if duration == 0:
-                duration = DEFAULT_DURATIONS["default"]
+            activity_lower = activity.lower()
+            duration = next((v for k, v in _DURATION_ITEMS if k in activity_lower), _DEFAULT_DURATION)
             
             # 시간표 항목을 테이블 행으로 추가
             timeline.append(f"| {current_time.strftime('%H:%M')} | {activity} | {name} | [🔗]({link}) |")
@@ -190,31 +236,34 @@ def create_timeline(recommendations, start_time):
         return "시간표를 생성할 수 없습니다."
 
 def create_download_content(last_recommendation_only=False):
-    """대화 내용을 텍스트 파일로 변환"""
+    """대화 내용을 텍스트 파일로 변환 (대화가 바뀌지 않았으면 이전 결과 재사용)"""
+    messages = st.session_state.messages
+    cache_key = (last_recommendation_only, len(messages), hash(messages[-1]["content"]) if messages else None)
+    cached = st.session_state.get("download_cache")
+    if cached and cached[0] == cache_key:
+        return cached[1]
+    
+    content = _build_download_content(last_recommendation_only)
+    st.session_state.download_cache = (cache_key, content)
+    return content
+
+def _build_download_content(last_recommendation_only):
+    """다운로드할 텍스트 생성"""
     if last_recommendation_only and st.session_state.last_recommendations:
         # 마지막 추천 내용만 포함
         content = ["🎈 추천 데이트 코스\n"]
         content.append(st.session_state.last_recommendations)
         
-        # 시간표 추가
-        start_time = "17:00"  # 기본값
-        for msg in reversed(st.session_state.messages):
-            if msg["role"] == "user":
-                start_time = extract_date_time(msg["content"])[1]
-                break
-        
-        timeline = create_timeline(st.session_state.last_recommendations, start_time)
+        # 시간표 추가 (마지막 사용자 입력에서 추출한 시작 시간 사용)
+        start_time = st.session_state.get("last_user_time", "17:00")
+        timeline = create_timeline(st.session_state.get("last_courses", []), start_time)
         content.append("\n📅 예상 시간표")
         content.append(timeline)
         
         return "\n".join(content)
     else:
         # 전체 대화 내용 포함
-        content = []
-        for msg in st.session_state.messages:
-            role = "👤 사용자" if msg["role"] == "user" else "🤖 챗봇"
-            content.append(f"{role}:\n{msg['content']}\n")
-        return "\n".join(content)
+        return "\n".join(f"{ROLES[msg['role']]}:\n{msg['content']}\n" for msg in st.session_state.messages)
 
 def get_filename():
     """현재 시간을 기반으로 파일명 생성"""
@@ -224,74 +273,49 @@ def get_filename():
 def get_place_info(url):
     """네이버 플레이스에서 별점과 리뷰 수를 가져옵니다."""
     try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        
         # URL이 유효한지 확인
-        if not url.startswith('https://place.naver.com/'):
+        if not url or not url.startswith('https://place.naver.com/'):
             return None
-            
-        # 페이지 요청
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        
-        # HTML 파싱
-        soup = BeautifulSoup(response.text, 'html.parser')
         
-        # 별점 정보 찾기
-        rating_element = soup.select_one('span[class*="rating"]')
-        review_count_element = soup.select_one('span[class*="review_count"]')
-        
-        if rating_element and review_count_element:
-            rating = rating_element.get_text().strip()
-            review_count = review_count_element.get_text().strip()
-            return f"{rating}/5.0 ({review_count})"
-        
-        return None
+        return _fetch_place_info(url)
         
     except Exception as e:
         print(f"Error fetching place info: {str(e)}")
         return None
 
-def update_place_ratings(recommendations):
-    """추천된 장소들의 별점 정보를 업데이트합니다."""
-    try:
-        # 코스 정보 찾기
-        courses = re.findall(r'(### \*\*\[코스 \d+\].*?)(?=### \*\*\[코스 \d+\]|$)', recommendations, re.DOTALL)
-        
-        updated_recommendations = []
-        for course in courses:
-            # URL 찾기
-            url_match = re.search(r'🔗 네이버 링크: (https://place\.naver\.com/[^\n]+)', course)
-            if url_match:
-                url = url_match.group(1).strip()
-                # 별점 정보 가져오기
-                rating_info = get_place_info(url)
-                
-                if rating_info:
-                    # 기존 별점 정보 교체
-                    course = re.sub(
-                        r'⭐ 별점: [^\n]+',
-                        f'⭐ 별점: {rating_info}',
-                        course
-                    )
-            
-            updated_recommendations.append(course)
-            # 네이버 서버 부하 방지를 위한 딜레이
-            time.sleep(1)
-        
-        return ''.join(updated_recommendations)
-        
-    except Exception as e:
-        print(f"Error updating ratings: {str(e)}")
-        return recommendations
+@st.cache_data(ttl=3600, show_spinner=False)
+def _fetch_place_info(url):
+    """별점 페이지를 요청해 파싱 (요청 실패 시 예외가 발생하므로 실패 결과는 캐시되지 않음)"""
+    # 페이지 요청 (네이버 서버 부하 방지를 위해 동시 요청 수 제한)
+    with get_naver_semaphore():
+        response = get_http_session().get(url, timeout=5)
+    response.raise_for_status()
+    
+    # 별점 정보 찾기 (HTML 트리를 만들지 않고 필요한 span만 추출)
+    rating_match = _RATING_RE.search(response.content)
+    review_count_match = _REVIEW_COUNT_RE.search(response.content)
+    
+    if rating_match and review_count_match:
+        rating = rating_match.group(1).decode('utf-8', 'replace').strip()
+        review_count = review_count_match.group(1).decode('utf-8', 'replace').strip()
+        return f"{rating}/5.0 ({review_count})"
+    
+    return None
+
+@st.cache_resource
+def get_search_url_cache():
+    """재실행 후에도 유지되는 검색 URL 메모 (가게명 -> URL)"""
+    return {}
 
 def search_place(query):
     """네이버 지도 검색 URL을 생성합니다."""
+    cache = get_search_url_cache()
+    if query in cache:
+        return cache[query]
+    
     try:
         # 검색어에서 불필요한 문자 제거
-        clean_query = re.sub(r'\([^)]*\)\**', '', query).strip()
+        clean_query = _PAREN_RE.sub('', query).strip()
         
         # URL 인코딩
         encoded_name = urllib.parse.quote(clean_query)
@@ -299,46 +323,193 @@ def search_place(query):
         # 네이버 지도 검색 URL 생성
         search_url = f"https://map.naver.com/p/search/{encoded_name}"
         print(f"Generated search URL for {clean_query}: {search_url}")  # 디버깅용 로그
+        
+        # 메모가 너무 커지지 않도록 가득 차면 비우기
+        if len(cache) >= 1024:
+            cache.clear()
+        cache[query] = search_url
         return search_url
         
     except Exception as e:
         print(f"Error generating search URL: {str(e)}")
         return None
 
-def update_place_links(recommendations):
-    """추천된 장소들의 네이버 지도 검색 링크를 업데이트합니다."""
+def split_courses(recommendations):
+    """추천 내용을 코스 헤더 위치 기준으로 잘라 코스별 문자열 목록으로 반환"""
+    starts = [m.start() for m in _COURSE_HEADER_RE.finditer(recommendations)]
+    ends = starts[1:] + [len(recommendations)]
+    return [recommendations[start:end] for start, end in zip(starts, ends)]
+
+def update_place_info(recommendations, prefetched=None):
+    """추천된 장소들의 네이버 지도 검색 링크와 별점 정보를 한 번에 업데이트합니다."""
     try:
-        # 코스 정보 찾기
-        courses = re.findall(r'(### \*\*\[코스 \d+\].*?)(?=### \*\*\[코스 \d+\]|$)', recommendations, re.DOTALL)
+        # 스트리밍 중 미리 시작한 별점 조회 (URL -> Future)
+        prefetched = prefetched or {}
+        executor = get_executor()
         
-        updated_recommendations = []
+        # 코스별 검색 링크 생성 및 별점 조회 시작
+        courses = split_courses(recommendations)
+        names = []
+        link_matches = []
+        rating_matches = []
+        search_urls = []
+        rating_futures = []
         for course in courses:
-            # 가게명 찾기
-            name_match = re.search(r'\[코스 \d+\]\s*([^\n]+)', course)
-            if name_match:
-                place_name = name_match.group(1).strip()
-                print(f"Processing place: {place_name}")  # 디버깅용 로그
-                
-                # 네이버 지도 검색 링크 생성
-                search_url = search_place(place_name)
-                
-                if search_url:
-                    # 기존 링크 정보 교체
-                    course = re.sub(
-                        r'🔗 네이버 링크:.*?\n',
-                        f'🔗 네이버 링크: {search_url}\n',
-                        course
-                    )
-                    print(f"Updated link for {place_name}: {search_url}")  # 디버깅용 로그
+            name_match = _NAME_RE.search(course)
+            names.append(name_match.group(1).strip() if name_match else "")
+            search_urls.append(search_place(names[-1]) if names[-1] else None)
+            
+            link_match = _LINK_RE.search(course)
+            link_matches.append(link_match)
+            rating_match = _RATING_LINE_RE.search(course)
+            rating_matches.append(rating_match)
+            url = link_match.group(1).strip() if link_match else ""
+            # 별점 줄이 있는 코스만 네이버에서 별점 조회
+            # (현재 시스템 프롬프트는 별점 줄을 요청하지 않으므로 보통은 조회하지 않음)
+            if url.startswith('https://place.naver.com/') and rating_match:
+                rating_futures.append(prefetched.get(url) or executor.submit(get_place_info, url))
+            else:
+                rating_futures.append(None)
+        
+        # 병렬로 조회한 별점 정보 모으기
+        ratings = [future.result() if future else None for future in rating_futures]
+        
+        updated_recommendations = []
+        parsed_courses = []
+        for course, name, link_match, rating_match, search_url, rating_info in zip(
+            courses, names, link_matches, rating_matches, search_urls, ratings
+        ):
+            # 링크와 별점 줄을 찾은 위치 그대로 잘라 붙여 교체 (뒤쪽부터 교체해야 앞쪽 위치가 유지됨)
+            replacements = []
+            if link_match and search_url:
+                replacements.append((link_match.start(), link_match.end(), f'🔗 네이버 링크: {search_url}'))
+            if rating_match and rating_info:
+                replacements.append((rating_match.start(), rating_match.end(), f'⭐ 별점: {rating_info}'))
+            for start, end, text in sorted(replacements, reverse=True):
+                course = course[:start] + text + course[end:]
             
             updated_recommendations.append(course)
+            
+            # 시간표용 (장소, 활동, 링크) 정보 저장
+            activity_match = _ACTIVITY_RE.search(course)
+            parsed_courses.append((
+                name,
+                activity_match.group(1).strip() if activity_match else "",
+                search_url or (link_match and link_match.group(1).strip()) or "#",
+            ))
         
-        result = ''.join(updated_recommendations)
-        return result
+        return ''.join(updated_recommendations), parsed_courses
         
     except Exception as e:
-        print(f"Error updating links: {str(e)}")
-        return recommendations
+        print(f"Error updating place info: {str(e)}")
+        return recommendations, []
+
+def generate_recommendations(full_prompt):
+    """Gemini 응답을 스트리밍으로 받으면서, 완성된 코스의 별점 조회를 미리 시작합니다."""
+    executor = get_executor()
+    prefetched = {}
+    chunks = []
+    pending = ""  # 아직 다음 코스 헤더가 나오지 않은 마지막 코스
+    
+    for chunk in model.generate_content(full_prompt, stream=True):
+        try:
+            piece = chunk.text
+        except ValueError:
+            # 텍스트가 없는 청크 (안전 필터, 종료 신호 등)는 건너뛰기
+            continue
+        chunks.append(piece)
+        pending += piece
+        
+        # 다음 코스 헤더가 나타난 코스는 완성된 것으로 보고, 별점 줄이 있으면 별점 조회 시작
+        while header := _COURSE_HEADER_RE.search(pending, 1):
+            course, pending = pending[:header.start()], pending[header.start():]
+            url_match = _URL_RE.search(course)
+            if url_match and _RATING_LINE_RE.search(course):
+                url = url_match.group(1).strip()
+                if url not in prefetched:
+                    prefetched[url] = executor.submit(get_place_info, url)
+    
+    # 마지막 코스까지 반영하여 링크와 별점 업데이트
+    return update_place_info("".join(chunks), prefetched)
+
+def format_course(index, course):
+    """JSON으로 받은 코스 정보를 추천 형식의 마크다운으로 변환"""
+    return f"""### **[코스 {index}] {course['name']}**
+
+🎯 내용: {course['activity']}
+
+✨ 추천 이유: {course['reason']}
+
+💰 가격대: {course['price']}
+
+🔗 네이버 링크:
+
+"""
+
+def mentions_course(prompt, courses):
+    """피드백이 특정 코스(번호, 가게명, 활동 종류)를 가리키는지 확인"""
+    if _COURSE_REF_RE.search(prompt):
+        return True
+    for name, activity, _ in courses:
+        place_name = _PAREN_RE.sub('', name).strip("* ")
+        if place_name and place_name in prompt:
+            return True
+        if any(key in prompt and key in activity.lower() for key, _ in _DURATION_ITEMS):
+            return True
+    return False
+
+def apply_feedback(prompt):
+    """피드백으로 바뀌는 코스만 JSON으로 받아 교체합니다. 교체할 코스가 없거나 실패하면 None을 반환합니다."""
+    try:
+        courses = split_courses(st.session_state.last_recommendations)
+        parsed_courses = list(st.session_state.get("last_courses", []))
+        if not courses or len(courses) != len(parsed_courses):
+            return None
+        
+        full_prompt = f"""
+당신은 데이트 코스 추천 챗봇입니다. 사용자 피드백에 따라 이전 추천 코스 중 바꿔야 하는 코스만 골라 새 장소로 교체합니다.
+새 장소는 실제로 존재하는 곳이어야 하며, 피드백 받지 않은 코스는 포함하지 마세요.
+반드시 아래 형식의 JSON만 반환하세요. index는 바꿀 코스의 번호입니다.
+{{"replacements": [{{"index": 1, "name": "가게명", "activity": "구체적인 활동 설명", "reason": "추천 이유", "price": "1인당 예상 비용"}}]}}
+
+이전 추천 코스:
+{st.session_state.last_recommendations}
+
+사용자 피드백: {prompt}
+"""
+        response = model.generate_content(
+            full_prompt,
+            generation_config=genai.GenerationConfig(response_mime_type="application/json")
+        )
+        replacements = {
+            int(item["index"]) - 1: item
+            for item in json.loads(response.text)["replacements"]
+            if 1 <= int(item["index"]) <= len(courses)
+        }
+        if not replacements:
+            return None
+        
+        # 바뀐 코스만 링크와 별점 업데이트
+        indices = sorted(replacements)
+        new_text, new_parsed = update_place_info(
+            "".join(format_course(i + 1, replacements[i]) for i in indices)
+        )
+        new_courses = split_courses(new_text)
+        if len(new_courses) != len(indices) or len(new_parsed) != len(indices):
+            return None
+        
+        for i, course, parsed in zip(indices, new_courses, new_parsed):
+            # 기존 코스의 마지막 항목 줄 뒤에 있던 글(마무리 인사 등)은 그대로 유지
+            field_lines = list(_FIELD_LINE_RE.finditer(courses[i]))
+            tail = courses[i][field_lines[-1].end():] if field_lines else "\n\n"
+            courses[i] = course.rstrip("\n") + tail
+            parsed_courses[i] = parsed
+        
+        return "".join(courses), parsed_courses
+        
+    except Exception as e:
+        print(f"Error applying feedback: {str(e)}")
+        return None
 
 # 페이지 설정
 st.set_page_config(
@@ -375,6 +546,8 @@ st.markdown("""
 if "messages" not in st.session_state:
     st.session_state.messages = []
     st.session_state.last_recommendations = None
+    st.session_state.last_courses = []
+    st.session_state.last_user_time = "17:00"
 
 # 이전 대화 내용 표시
 for message in st.session_state.messages:
@@ -385,16 +558,26 @@ for message in st.session_state.messages:
 if prompt := st.chat_input("데이트 코스를 추천해드릴게요! 어떤 데이트를 계획하시나요?"):
     # 사용자 메시지 표시
     st.chat_message("user").markdown(prompt)
-    # 사용자 메시지 저장
-    st.session_state.messages.append({"role": "user", "content": prompt})
     
     # 날짜와 시간 추출
     date_str, time_str = extract_date_time(prompt)
     
-    # Gemini 모델에 전송할 프롬프트 구성
-    if st.session_state.last_recommendations and any(keyword in prompt.lower() for keyword in ["바꿔", "교체", "다른", "비싸", "너무", "별로"]):
-        # 피드백 처리를 위한 프롬프트
-        full_prompt = f"""
+    # 사용자 메시지 저장 (다운로드 시 다시 파싱하지 않도록 추출한 시간도 함께 저장)
+    st.session_state.messages.append({"role": "user", "content": prompt})
+    st.session_state.last_user_time = time_str
+    
+    # 피드백이면서 특정 코스를 가리킬 때만 바뀐 코스를 JSON으로 받아 교체
+    # (JSON 교체가 실패하면 전체 피드백 프롬프트로 Gemini를 한 번 더 호출하므로,
+    #  코스를 특정하지 않은 피드백은 처음부터 전체 피드백 프롬프트를 사용)
+    is_feedback = st.session_state.last_recommendations and _FEEDBACK_RE.search(prompt) is not None
+    targets_course = is_feedback and mentions_course(prompt, st.session_state.get("last_courses", []))
+    result = apply_feedback(prompt) if targets_course else None
+    
+    if result is None:
+        # Gemini 모델에 전송할 프롬프트 구성
+        if is_feedback:
+            # 피드백 처리를 위한 프롬프트 (JSON 교체에 실패한 경우)
+            full_prompt = f"""
 {context}
 
 이전 추천 코스:
@@ -405,24 +588,22 @@ if prompt := st.chat_input("데이트 코스를 추천해드릴게요! 어떤 
 위 피드백을 반영하여 필요한 부분만 수정한 새로운 코스를 추천해주세요.
 이전 추천에서 피드백 받지 않은 장소들은 그대로 유지해주세요.
 """
-    else:
-        # 새로운 코스 추천을 위한 프롬프트
-        full_prompt = f"{context}\n\n사용자: {prompt}\n\n위 사용자의 요청에 맞는 데이트 코스를 추천해주세요."
+        else:
+            # 새로운 코스 추천을 위한 프롬프트
+            full_prompt = f"{context}\n\n사용자: {prompt}\n\n위 사용자의 요청에 맞는 데이트 코스를 추천해주세요."
+        
+        # Gemini 모델 호출 및 네이버 지도 링크, 별점 업데이트
+        result = generate_recommendations(full_prompt)
     
-    # Gemini 모델 호출
-    response = model.generate_content(full_prompt)
+    response_with_links, courses = result
     
-    # 네이버 지도 링크 업데이트
-    response_with_links = update_place_links(response.text)
+    # 시간표 생성 후 저장/표시할 마크다운을 한 번에 구성
+    timeline = create_timeline(courses, time_str)
+    assistant_content = response_with_links + "\n\n### 📅 예상 시간표\n" + timeline
     
     # 어시스턴트 응답 표시
     with st.chat_message("assistant"):
-        st.markdown(response_with_links)
-        
-        # 시간표 생성 및 표시
-        st.markdown("\n### 📅 예상 시간표")
-        timeline = create_timeline(response_with_links, time_str)
-        st.markdown(timeline)
+        st.markdown(assistant_content)
         
         # 시간표 아래에 참고 사항 추가
         st.markdown("""
@@ -432,11 +613,14 @@ if prompt := st.chat_input("데이트 코스를 추천해드릴게요! 어떤 
         """)
     
     # 응답 저장
-    st.session_state.messages.append({"role": "assistant", "content": response_with_links + "\n\n### 📅 예상 시간표\n" + timeline})
+    st.session_state.messages.append({"role": "assistant", "content": assistant_content})
     st.session_state.last_recommendations = response_with_links
+    st.session_state.last_courses = courses
 
 # 버튼 컨테이너를 대화 맨 아래에 배치
-if st.session_state.messages:  # 대화가 있을 때만 버튼들 표시
+@st.fragment
+def render_buttons():
+    """버튼 영역만 다시 그리도록 프래그먼트로 분리 (버튼 클릭 시 대화 내용은 다시 그리지 않음)"""
     st.divider()
     col1, col2, col3 = st.columns(3)
     
@@ -444,7 +628,9 @@ if st.session_state.messages:  # 대화가 있을 때만 버튼들 표시
         if st.button("🔄 다시 짜기", use_container_width=True):
             st.session_state.messages = []
             st.session_state.last_recommendations = None
-            st.rerun()
+            st.session_state.last_courses = []
+            st.session_state.last_user_time = "17:00"
+            st.rerun(scope="app")
     
     with col2:
         if st.session_state.last_recommendations:
@@ -464,3 +650,6 @@ if st.session_state.messages:  # 대화가 있을 때만 버튼들 표시
                 st.info("추후 업데이트될 예정입니다! 현재는 데이트 코스를 저장하여 공유해주세요. 😊")
         else:
             st.button("🔗 코스 공유하기", disabled=True, use_container_width=True)
+
+if st.session_state.messages:  # 대화가 있을 때만 버튼들 표시
+    render_buttons()